@@ -7,20 +7,22 @@ import warnings
 from tqdm.notebook import tqdm
 from sklearn.preprocessing import LabelEncoder
 from sklearn.metrics import roc_auc_score
+from joblib import Parallel, delayed
 import numpy as np
+try:
+    from modules.preprocessing import filter_rank, split_sex_age, split_weight, parse_date
+except ModuleNotFoundError:
+    from preprocessing import filter_rank, split_sex_age, split_weight, parse_date
 warnings.filterwarnings("ignore")
 
 def parse_horse_file(horse_results):
-    df = horse_results.copy()
     # 着順に数字以外の文字列が含まれているものを取り除く
-    df['着順'] = pd.to_numeric(df['着順'], errors='coerce')
-    df.dropna(subset = ['着順'], inplace=True)
-    df['着順']= df['着順'].astype(int)
+    df = filter_rank(horse_results)
 
-    df['date'] = pd.to_datetime(df['日付'])
+    df['date'] = parse_date(df['日付'], format='%Y/%m/%d')
     df.drop(['日付'], axis=1, inplace=True) 
 
-    df['賞金'].fillna(0, inplace=True)
+    df['賞金'] = df['賞金'].fillna(0)
     return df
 
 def get_average_horse_results(horse_results,horse_id_list,date,n_samples = 'all'):
@@ -67,6 +69,43 @@ def gain(return_func,X,n_samples = 100,lower = 50,min_threshold = 0.5):
             gain[n_bets] = return_rate
     return pd.Series(gain)
 
+def _bootstrap_chunk(payout,cost,n_bootstrap,seed):
+    #レース単位の重み(各レースが何回選ばれたか)を多項分布から一括で生成する
+    rng = np.random.default_rng(seed)
+    n_races = payout.shape[0]
+    weights = rng.multinomial(n_races, np.full(n_races, 1/n_races), size=n_bootstrap).astype(float)
+    total_cost = weights @ cost
+    total_payout = weights @ payout
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(total_cost > 0, total_payout/total_cost, np.nan)
+
+def bootstrap_return(payout,n_bets,n_bootstrap = 1000,alpha = 0.05,lower = 50,chunk_size = 500,n_jobs = -1,random_state = None):
+    """
+    レース×閾値の払い戻し額と賭け数の行列から、レース単位のブートストラップで回収率の信頼区間を求める関数
+    """
+    payout = payout.astype(float)
+    n_bets = n_bets.astype(float)
+    cost = 100 * n_bets.values
+
+    chunks = [min(chunk_size, n_bootstrap - i) for i in range(0, n_bootstrap, chunk_size)]
+    seeds = np.random.SeedSequence(random_state).spawn(len(chunks))
+    #numpyの行列積はGILを解放するのでスレッドで並列化する
+    results = Parallel(n_jobs=n_jobs, prefer='threads')(
+        delayed(_bootstrap_chunk)(payout.values,cost,size,seed) for size,seed in zip(chunks,seeds)
+    )
+    return_rates = np.vstack(results)
+
+    total_bets = n_bets.sum()
+    total_payout = payout.sum()
+    df = pd.DataFrame({
+        'n_bets': total_bets.astype(int),
+        'return_rate': total_payout/(100 * total_bets),
+        'lower': np.nanpercentile(return_rates, 100 * alpha/2, axis=0),
+        'upper': np.nanpercentile(return_rates, 100 * (1 - alpha/2), axis=0),
+    }, index=payout.columns)
+    df.index.name = 'threshold'
+    return df[df['n_bets'] > lower]
+
 class Return:
     def __init__(self,return_tables):
         self.return_tables = return_tables
@@ -150,6 +189,47 @@ class ModelEvaluator:
         return_rate = (n_bets * 100 + money)/(n_bets * 100)
         return n_bets,return_rate
 
+    def hit_return(self,X,return_type = 'tansho'):
+        """
+        各馬に100円賭けたときの払い戻し額を返す関数(外れは0)
+        """
+        if return_type == 'tansho':
+            table = self.tansho.dropna()
+        elif return_type == 'fukusho':
+            table = pd.concat([
+                self.fukusho[[f'win_{i}', f'return_{i}']].set_axis(['win', 'return'], axis=1) for i in range(3)
+            ])
+            table = table[table['win'] > 0]
+        else:
+            raise ValueError('return_type must be "tansho" or "fukusho"')
+        table = table.astype(int).rename_axis('race_id').reset_index()
+
+        horses = pd.DataFrame({'race_id': X.index, '馬番': X['馬番'].values, 'row': np.arange(len(X))})
+        hits = horses.merge(table, left_on=['race_id', '馬番'], right_on=['race_id', 'win'], how='inner')
+        hit_return = hits.groupby('row')['return'].sum().reindex(np.arange(len(X)), fill_value=0)
+        return pd.Series(hit_return.values, index=X.index)
+
+    def race_profit_matrix(self,X,return_type = 'tansho',n_samples = 100):
+        """
+        レース×閾値の払い戻し額と賭け数の行列を返す関数
+        """
+        thresholds = np.arange(n_samples)/n_samples
+        proba = self.predict_proba(X).values
+        bets = (proba[:, None] >= thresholds[None, :]).astype(int)
+        hit_return = self.hit_return(X,return_type).values
+
+        n_bets = pd.DataFrame(bets, index=X.index, columns=thresholds).groupby(level = 0).sum()
+        payout = pd.DataFrame(bets * hit_return[:, None], index=X.index, columns=thresholds).groupby(level = 0).sum()
+        return payout,n_bets
+
+    def bootstrap_return(self,X,return_type = 'tansho',n_samples = 100,n_bootstrap = 1000,alpha = 0.05,lower = 50,chunk_size = 500,n_jobs = -1,random_state = None):
+        """
+        閾値ごとの回収率とレース単位のブートストラップによる信頼区間を返す関数
+        """
+        payout,n_bets = self.race_profit_matrix(X,return_type,n_samples)
+        return bootstrap_return(payout,n_bets,n_bootstrap=n_bootstrap,alpha=alpha,lower=lower,
+                                chunk_size=chunk_size,n_jobs=n_jobs,random_state=random_state)
+
     def tansho_return_proper(self,X,threshold = 0.5):
         pred_table = self.predict_table(X,threshold)
         n_bets = len(pred_table)
@@ -265,14 +345,15 @@ class ShutubaTable(DataProcessor):
             time.sleep(1)
     
     def preprocessing(self):
-        df = self.data.copy()
+        #必要な列だけを取り出す(全体はコピーしない)
+        df = self.data[['枠', '馬番', '斤量', '性齢', '馬体重(増減)', 'course_len', 'weather', 'race_type',
+        'ground_state', 'date', 'horse_id', 'jockey_id']]
 
         #convert to int
         df[['枠', '馬番', '斤量']] = df[['枠', '馬番', '斤量']].astype(int)
 
         #性齢を性と年齢に分割
-        df['性']= df['性齢'].map(lambda x: str(x)[0])
-        df['年齢']= df['性齢'].map(lambda x: str(x)[1:]).astype(int)
+        split_sex_age(df)
         
         # #馬体重を体重と体重変化に分割
         try:
@@ -280,8 +361,7 @@ class ShutubaTable(DataProcessor):
                 df['体重'] = np.nan
                 df['体重変化'] = np.nan
             else:   
-                df['体重']= df['馬体重(増減)'].str.split('(').str[0].astype(int)
-                df['体重変化']= df['馬体重(増減)'].str.split('(').str[1].str.split(')').str[0].astype(int)
+                split_weight(df, '馬体重(増減)')
         except:
             print('something error')
         
@@ -298,27 +378,20 @@ class Results(DataProcessor):
         self.data = results
 
     def preprocessing(self):
-        df = self.data.copy()
         # 着順に数字以外の文字列が含まれているものを取り除く
-        df = df[~(df['着順'].astype(str).str.contains('\D'))]
-        df['着順']= df['着順'].astype(int)
-        df['rank'] = df['着順'].map(lambda x: 1 if x < 4 else 0)
+        df = filter_rank(self.data)
+        df['rank'] = (df['着順'] < 4).astype(int)
 
         #性齢を性と年齢に分割
-        df['性']= df['性齢'].map(lambda x: str(x)[0])
-        df['年齢']= df['性齢'].map(lambda x: str(x)[1:]).astype(int)
+        split_sex_age(df)
         
         # #馬体重を体重と体重変化に分割
-        df['体重']= df['馬体重'].str.split('(').str[0].astype(int)
-        df['体重変化']= df['馬体重'].str.split('(').str[1].str.split(')').str[0].astype(int)
-        
-        #データをfloat型に変換
-        df['単勝']= df['単勝'].astype(float)
+        split_weight(df, '馬体重')
         
         #いらない列を削除
-        df = df.drop(['タイム', '着差', '調教師', '性齢', '馬体重','馬名', '騎手', '単勝', '着順', '人気'], axis=1)
+        df.drop(['タイム', '着差', '調教師', '性齢', '馬体重','馬名', '騎手', '単勝', '着順', '人気'], axis=1, inplace=True)
         
-        df['date'] = pd.to_datetime(df['date'], format='%Y年%m月%d日')
+        df['date'] = parse_date(df['date'], format='%Y年%m月%d日')
         
         self.data_p = df
 
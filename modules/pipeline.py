@@ -0,0 +1,319 @@
+"""
+スクレイピングから特徴量作成までをステージのDAGとして実行するコマンドラインツール
+
+    python -m modules.pipeline run --start-year 2024 --end-year 2025
+    python -m modules.pipeline status
+
+各ステージは入力と出力を宣言し、入力の内容ハッシュが前回の実行時から変わっていなければスキップされる。
+ファイルごとのハッシュは(サイズ, 更新時刻)と一緒に状態ファイルに保存し、変わっていないファイルは読み直さない。
+途中で失敗しても、成功したステージまでは再計算せずに再開できる。
+fetch_raceは取得する年だけがハッシュの対象なので、同じ期間の新しいレースを取りに行くときは--force fetch_raceを付ける。
+pandas等の重いモジュールはステージの実行時に読み込むので、CLIの起動は速い。
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+STATE_PATH = 'data/pipeline_state.json'
+
+RACE_HTML = 'data/html/race'
+HORSE_HTML = 'data/html/horse'
+PED_HTML = 'data/html/ped'
+RACE_RESULTS = 'data/raw/race_results/race_results.pickle'
+RACE_INFOS = 'data/raw/race_infos/race_infos.pickle'
+RETURN_TABLES = 'data/raw/return_tables/return_tables.pickle'
+HORSE = 'data/raw/horse/horse.pickle'
+PEDS = 'data/raw/peds/peds.pickle'
+PEDS_E = 'data/processed/peds_e.pickle'
+RESULTS_PE = 'data/processed/results_pe.pickle'
+RESULTS_C = 'data/processed/results_c.pickle'
+LE_HORSE = 'data/processed/le_horse.pickle'
+LE_JOCKEY = 'data/processed/le_jockey.pickle'
+
+def _prepare_data():
+    try:
+        from modules import prepareData
+    except ModuleNotFoundError:
+        import prepareData
+    return prepareData
+
+def _data_formatter():
+    try:
+        from modules import DataFormatter
+    except ModuleNotFoundError:
+        import DataFormatter
+    return DataFormatter
+
+class Hasher:
+    """
+    入力パス(ファイルまたは.binファイルのディレクトリ)の内容ハッシュを計算するクラス。
+    パスごとのハッシュは1回のrun/statusの中で使い回し、ファイルごとのハッシュは(サイズ, 更新時刻)が同じなら読み直さない。
+    """
+    def __init__(self, files: dict):
+        self.files = files # {file: [size, mtime_ns, digest]}
+        self.paths = {}
+
+    def file_digest(self, file: str):
+        stat = os.stat(file)
+        cached = self.files.get(file)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        h = hashlib.blake2b(digest_size=16)
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        self.files[file] = [stat.st_size, stat.st_mtime_ns, h.hexdigest()]
+        return self.files[file][2]
+
+    def path_digest(self, path: str):
+        if path in self.paths:
+            return self.paths[path]
+        h = hashlib.blake2b(digest_size=16)
+        if os.path.isdir(path):
+            files = sorted(glob.glob(f'{path}/*.bin'))
+            #削除されたファイルのキャッシュを取り除く
+            prefix = os.path.join(path, '')
+            for file in set(key for key in self.files if key.startswith(prefix)) - set(files):
+                del self.files[file]
+        else:
+            files = [path] if os.path.isfile(path) else []
+        for file in files:
+            h.update(os.path.basename(file).encode())
+            h.update(self.file_digest(file).encode())
+        self.paths[path] = h.hexdigest()
+        return self.paths[path]
+
+    def invalidate(self, paths: list):
+        for path in paths:
+            self.paths.pop(path, None)
+
+class Stage:
+    def __init__(self, name: str, func, inputs: list = None, outputs: list = None, params: dict = None):
+        self.name = name
+        self.func = func
+        self.inputs = inputs if inputs is not None else []
+        self.outputs = outputs if outputs is not None else []
+        self.params = params if params is not None else {}
+
+    def input_hash(self, hasher: Hasher):
+        """
+        入力のハッシュとパラメータからステージのハッシュを計算する関数
+        """
+        h = hashlib.blake2b(digest_size=16)
+        h.update(json.dumps(self.params, sort_keys=True).encode())
+        for path in self.inputs:
+            h.update(path.encode())
+            h.update(hasher.path_digest(path).encode())
+        return h.hexdigest()
+
+    def outputs_exist(self):
+        return all(os.path.exists(path) for path in self.outputs)
+
+    def run(self):
+        #出力先のディレクトリがなければ作成する
+        for path in self.outputs:
+            directory = os.path.dirname(path) if os.path.splitext(path)[1] else path
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        self.func(**self.params)
+
+def fetch_race(start_year: int, end_year: int):
+    """
+    raceページを取得してレース結果テーブルに変換する関数。
+    getRawDataRaceResultsは読めないページを削除するので、後続のステージが使うdata/html/raceはこのステージの中で確定させる。
+    """
+    prepareData = _prepare_data()
+    prepareData.getHTMLRace(prepareData.get_race_id_list(start_year, end_year))
+    prepareData.getRawDataRaceResults(prepareData.get_html_path_list('race')).to_pickle(RACE_RESULTS)
+
+def parse_race_infos():
+    prepareData = _prepare_data()
+    prepareData.getRawDataRaceInfos(prepareData.get_html_path_list('race')).to_pickle(RACE_INFOS)
+
+def parse_return_tables():
+    prepareData = _prepare_data()
+    prepareData.getRawDataReturnTables(prepareData.get_html_path_list('race')).to_pickle(RETURN_TABLES)
+
+def fetch_horse():
+    prepareData = _prepare_data()
+    prepareData.getHTMLHorse(prepareData.get_horse_id_list())
+
+def parse_horse():
+    prepareData = _prepare_data()
+    prepareData.getRawDataHorse(prepareData.get_html_path_list('horse')).to_pickle(HORSE)
+
+def fetch_ped():
+    prepareData = _prepare_data()
+    prepareData.getHTMLPed(prepareData.get_horse_id_list())
+
+def parse_ped():
+    prepareData = _prepare_data()
+    prepareData.getRawDataPeds(prepareData.get_html_path_list('ped')).to_pickle(PEDS)
+
+def encode_peds():
+    import pandas as pd
+    DataFormatter = _data_formatter()
+    peds = DataFormatter.Peds(pd.read_pickle(PEDS))
+    peds.encode()
+    peds.peds_e.to_pickle(PEDS_E)
+
+def features():
+    import pandas as pd
+    DataFormatter = _data_formatter()
+    race_results = pd.read_pickle(RACE_RESULTS)
+    race_infos = pd.read_pickle(RACE_INFOS)
+    r = DataFormatter.Results(race_results.merge(race_infos, left_index=True, right_index=True, how='left'))
+    r.preprocessing()
+    r.merge_horse_results(pd.read_pickle(HORSE))
+    r.merge_peds(pd.read_pickle(PEDS_E))
+    r.data_pe.to_pickle(RESULTS_PE)
+
+def encode():
+    import pandas as pd
+    DataFormatter = _data_formatter()
+    r = DataFormatter.Results(pd.DataFrame())
+    r.data_pe = pd.read_pickle(RESULTS_PE)
+    r.process_categorycal()
+    r.data_c.to_pickle(RESULTS_C)
+    pd.to_pickle(r.le_horse, LE_HORSE)
+    pd.to_pickle(r.le_jockey, LE_JOCKEY)
+
+def build_stages(start_year: int = 2024, end_year: int = 2025):
+    """
+    fetch → parse → store → features → encodeのステージ一覧を返す関数
+    """
+    return [
+        Stage('fetch_race', fetch_race, outputs=[RACE_HTML, RACE_RESULTS], params={'start_year': start_year, 'end_year': end_year}),
+        Stage('parse_race_infos', parse_race_infos, inputs=[RACE_HTML], outputs=[RACE_INFOS]),
+        Stage('parse_return_tables', parse_return_tables, inputs=[RACE_HTML], outputs=[RETURN_TABLES]),
+        Stage('fetch_horse', fetch_horse, inputs=[RACE_RESULTS], outputs=[HORSE_HTML]),
+        Stage('parse_horse', parse_horse, inputs=[HORSE_HTML], outputs=[HORSE]),
+        Stage('fetch_ped', fetch_ped, inputs=[RACE_RESULTS], outputs=[PED_HTML]),
+        Stage('parse_ped', parse_ped, inputs=[PED_HTML], outputs=[PEDS]),
+        Stage('encode_peds', encode_peds, inputs=[PEDS], outputs=[PEDS_E]),
+        Stage('features', features, inputs=[RACE_RESULTS, RACE_INFOS, HORSE, PEDS_E], outputs=[RESULTS_PE]),
+        Stage('encode', encode, inputs=[RESULTS_PE], outputs=[RESULTS_C, LE_HORSE, LE_JOCKEY]),
+    ]
+
+def dependencies(stages: list):
+    """
+    各ステージが依存する(入力を出力する)ステージ名の集合を返す関数
+    """
+    producer = {path: stage.name for stage in stages for path in stage.outputs}
+    return {stage.name: {producer[path] for path in stage.inputs if path in producer} for stage in stages}
+
+def load_state(path: str = STATE_PATH):
+    """
+    ステージごとの入力ハッシュ(stages)とファイルごとのハッシュ(files)を読み込む関数
+    """
+    state = {}
+    if os.path.isfile(path):
+        with open(path) as f:
+            state = json.load(f)
+    state.setdefault('stages', {})
+    state.setdefault('files', {})
+    return state
+
+def save_state(state: dict, path: str = STATE_PATH):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def run(stages: list, force: list = None, max_workers: int = 2, state_path: str = STATE_PATH):
+    """
+    依存関係を満たしたステージから実行する関数。
+    入力のハッシュが前回と同じで出力が揃っているステージはスキップし、依存のないステージ(馬と血統など)は並列に実行する。
+    失敗したステージに依存するステージは実行しない。失敗したステージ名のリストを返す。
+    """
+    force = force or []
+    deps = dependencies(stages)
+    by_name = {stage.name: stage for stage in stages}
+    state = load_state(state_path)
+    hasher = Hasher(state['files'])
+    done, failed, running = set(), set(), {} # running: {future: (name, input_hash)}
+
+    def ready(name):
+        return (name not in done and name not in failed
+                and name not in [name for name, _ in running.values()] and deps[name] <= done)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            blocked = {name for name in by_name if deps[name] & failed}
+            failed |= blocked
+            for name in [name for name in by_name if ready(name)]:
+                stage = by_name[name]
+                input_hash = stage.input_hash(hasher)
+                if name not in force and state['stages'].get(name) == input_hash and stage.outputs_exist():
+                    print(f'{name} skipped.')
+                    done.add(name)
+                    continue
+                print(f'start {name}')
+                running[executor.submit(stage.run)] = (name, input_hash)
+            if not running:
+                if len(done) + len(failed) == len(by_name):
+                    break
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name, input_hash = running.pop(future)
+                #出力は書き換わったので、後続のステージでハッシュを計算し直す
+                hasher.invalidate(by_name[name].outputs)
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f'{name} failed: {e!r}')
+                    failed.add(name)
+                    continue
+                state['stages'][name] = input_hash
+                save_state(state, state_path)
+                done.add(name)
+                print(f'{name} done!')
+    #スキップしたステージで計算したファイルのハッシュも保存する
+    save_state(state, state_path)
+    return sorted(failed - {name for name in failed if deps[name] & failed})
+
+def status(stages: list, state_path: str = STATE_PATH):
+    state = load_state(state_path)
+    hasher = Hasher(state['files'])
+    for stage in stages:
+        if state['stages'].get(stage.name) == stage.input_hash(hasher) and stage.outputs_exist():
+            print(f'{stage.name}: up to date')
+        else:
+            print(f'{stage.name}: stale')
+
+def main(argv: list = None):
+    '''
+    メイン関数
+    '''
+    parser = argparse.ArgumentParser(prog='python -m modules.pipeline', description='競馬データのパイプラインを実行する')
+    parser.add_argument('command', choices=['run', 'status'])
+    parser.add_argument('--start-year', type=int, default=2024)
+    parser.add_argument('--end-year', type=int, default=2025)
+    parser.add_argument('--force', nargs='*', default=[], help='ハッシュに関わらず再実行するステージ名')
+    parser.add_argument('--max-workers', type=int, default=2)
+    parser.add_argument('--state', default=STATE_PATH)
+    args = parser.parse_args(argv)
+
+    stages = build_stages(args.start_year, args.end_year)
+    unknown = set(args.force) - {stage.name for stage in stages}
+    if unknown:
+        parser.error(f'unknown stage: {", ".join(sorted(unknown))}')
+
+    if args.command == 'status':
+        status(stages, args.state)
+        return 0
+    failed = run(stages, args.force, args.max_workers, args.state)
+    if failed:
+        print(f'failed stages: {", ".join(failed)}')
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,36 @@
+import pandas as pd
+
+def filter_rank(df, column: str = '着順'):
+    """
+    着順に数字以外の文字列(中止、除外等)が含まれている行を取り除き、着順をint型にする関数
+    """
+    rank = pd.to_numeric(df[column], errors='coerce')
+    mask = rank.notna()
+    #行の抽出でデータは1回だけコピーされるので、以降は列を直接書き換える
+    df = df[mask]
+    df[column] = rank[mask].astype(int)
+    return df
+
+def split_sex_age(df, column: str = '性齢'):
+    """
+    性齢を性と年齢に1回の正規表現で分割する関数(dfを直接書き換える)
+    """
+    sex_age = df[column].astype(str).str.extract(r'^(\D)(\d+)$')
+    df['性'] = sex_age[0]
+    df['年齢'] = sex_age[1].astype(int)
+    return df
+
+def split_weight(df, column: str = '馬体重'):
+    """
+    馬体重を体重と体重変化に1回の正規表現で分割する関数(dfを直接書き換える)
+    """
+    weight = df[column].str.extract(r'^(\d+)\(([+-]?\d+)\)$')
+    df['体重'] = weight[0].astype(int)
+    df['体重変化'] = weight[1].astype(int)
+    return df
+
+def parse_date(dates, format: str = '%Y年%m月%d日'):
+    """
+    日付の文字列を明示したフォーマットでdatetime型に変換する関数
+    """
+    return pd.to_datetime(dates, format=format)